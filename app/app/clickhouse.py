@@ -0,0 +1,43 @@
+import orjson
+from aiochclient import ChClient
+from aiohttp import ClientSession, ClientConnectorError, TCPConnector
+from aiohttp.web import Application
+
+from .clichouse_host import CLICKHOUSE_HOST
+from .util import try_for_a_while
+
+
+async def app_on_startup(app: Application, wait_for: float):
+    app['ch_http_session'] = ClientSession(
+        connector=TCPConnector(
+            limit=256,
+            limit_per_host=0,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+        ),
+    )
+
+    async def ch_client():
+        client = ChClient(
+            app['ch_http_session'],
+            url=f'http://{CLICKHOUSE_HOST}:8123',
+            database='ztf',
+            user='api',
+            json=orjson,
+            # we decode JSON rows with orjson and want to have UInt64 oids as numbers
+            output_format_json_quote_64bit_integers=0,
+        )
+        await client.fetch('SELECT 1')
+        return client
+
+    app['ch_client'] = await try_for_a_while(
+        ch_client,
+        wait_for=wait_for,
+        interval=1,
+        exception=ClientConnectorError,
+    )
+
+
+async def app_on_cleanup(app: Application):
+    await app['ch_http_session'].close()
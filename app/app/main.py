@@ -3,6 +3,8 @@
 Specify environment variable $API_VERSION to 'v1', 'v2', 'all', or 'v1:v2'.
 If no variable is presented, all versions will be used
 """
+from functools import partial
+
 from aiohttp.web import Application
 
 from . import root
@@ -22,16 +24,23 @@ async def get_app():
         app.on_cleanup.append(v1.app_on_cleanup)
         app.add_routes(v1.routes)
 
+    clickhouse_apis = []
+
     if 'v2' in api_versions:
         from . import v2
-        app.on_startup.append(v2.app_on_startup)
-        app.on_cleanup.append(v2.app_on_cleanup)
         app.add_routes(v2.routes)
+        clickhouse_apis.append(v2)
 
     if 'v3' in api_versions:
         from . import v3
-        app.on_startup.append(v3.app_on_startup)
-        app.on_cleanup.append(v3.app_on_cleanup)
         app.add_routes(v3.routes)
+        clickhouse_apis.append(v3)
+
+    # v2 and v3 share a single ClickHouse client and its connection pool
+    if clickhouse_apis:
+        from . import clickhouse
+        wait_for = max(api.CLICKHOUSE_WAIT_FOR for api in clickhouse_apis)
+        app.on_startup.append(partial(clickhouse.app_on_startup, wait_for=wait_for))
+        app.on_cleanup.append(clickhouse.app_on_cleanup)
 
     return app
@@ -37,11 +37,19 @@ _help_links = dict(
 )
 
 
-@routes.get('/')
-async def index(request) -> Response:
+def _index_html() -> str:
     api_versions = get_api_versions()
     links = '\n'.join(text for version, text in _help_links.items() if version in api_versions)
+    return _template.format(help=links)
+
+
+_INDEX_BYTES = _index_html().encode('utf-8')
+
+
+@routes.get('/')
+async def index(request) -> Response:
     return Response(
-        text=_template.format(help=links),
+        body=_INDEX_BYTES,
         content_type='text/html',
+        charset='utf-8',
     )
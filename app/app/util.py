@@ -1,8 +1,11 @@
 import asyncio
 import time
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
+from functools import partial, wraps
+from typing import Callable, Hashable, Iterable, List
 
-from aiohttp.web import HTTPBadRequest, Request
+import orjson
+from aiohttp.web import HTTPBadRequest, Request, Response
 
 
 def oid_to_int(oid: str) -> int:
@@ -12,21 +15,48 @@ def oid_to_int(oid: str) -> int:
         raise HTTPBadRequest(reason=f'oid value "{oid}" cannot be converted to int')
 
 
-def oids_from_request(request: Request) -> [int]:
+def oids_from_request(request: Request) -> List[int]:
+    """Unique OIDs from the query string, in order of their first appearance"""
     oids = request.query.getall('oid', None)
     if oids is None:
         raise HTTPBadRequest(reason='Query string should has at least one "oid" field')
-    return [oid_to_int(oid) for oid in oids]
+    try:
+        return list(dict.fromkeys(map(int, oids)))
+    except ValueError:
+        # Slow path to find the wrong value and report it
+        return list(dict.fromkeys(oid_to_int(oid) for oid in oids))
+
+
+def coerce_floats(record: dict, fields: Iterable[str]) -> dict:
+    """Convert fields back to float in-place, ClickHouse JSON output drops ".0" of whole float values"""
+    for field in fields:
+        value = record[field]
+        if value is not None:
+            record[field] = float(value)
+    return record
+
+
+def json_dumps(data) -> bytes:
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def json_response(data) -> Response:
+    """Faster drop-in replacement of aiohttp.web.json_response using orjson"""
+    return Response(
+        body=json_dumps(data),
+        content_type='application/json',
+    )
 
 
 RaDecRadius = namedtuple('RaDecRadius', ('ra', 'dec', 'radius'))
 
 
 def ra_dec_radius_from_request(request: Request, max_radius: float) -> RaDecRadius:
+    query = request.query
     try:
-        ra = float(request.query['ra'])
-        dec = float(request.query['dec'])
-        radius = float(request.query['radius_arcsec'])
+        ra = float(query['ra'])
+        dec = float(query['dec'])
+        radius = float(query['radius_arcsec'])
     except KeyError:
         raise HTTPBadRequest(reason='All of "ra", "dec" and "radius_arcsec" fields should be specified')
     except ValueError:
@@ -36,16 +66,58 @@ def ra_dec_radius_from_request(request: Request, max_radius: float) -> RaDecRadi
     return RaDecRadius(ra=ra, dec=dec, radius=radius)
 
 
-async def try_for_a_while(f, wait_for, interval=None, exception=Exception):
+async def try_for_a_while(f, wait_for, interval=None, exception=Exception, max_interval=5):
     if interval is None:
         interval = wait_for / 11
+    is_coroutine = asyncio.iscoroutinefunction(f)
+    error = None
     t_start = time.monotonic()
     while time.monotonic() - t_start < wait_for:
         try:
-            if asyncio.iscoroutinefunction(f):
+            if is_coroutine:
                 return await f()
             else:
                 return f()
         except exception as e:
+            error = e
             await asyncio.sleep(interval)
-    raise RuntimeError(f'Function {f} calls are timed out') from e
+            interval = min(2 * interval, max(interval, max_interval))
+    raise RuntimeError(f'Function {f} calls are timed out') from error
+
+
+def async_lru_cache(maxsize: int, key: Callable[..., Hashable]):
+    """LRU cache for coroutine functions, key is computed from call arguments by `key`
+
+    Concurrent calls with the same key share a single call of the wrapped function
+    """
+    def decorator(f):
+        cache = OrderedDict()
+        pending = {}
+
+        def done(k, future):
+            del pending[k]
+            if future.cancelled() or future.exception() is not None:
+                return
+            cache[k] = future.result()
+            if len(cache) > maxsize:
+                cache.popitem(last=False)
+
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            try:
+                cache.move_to_end(k)
+                return cache[k]
+            except KeyError:
+                pass
+            future = pending.get(k)
+            if future is None:
+                future = pending[k] = asyncio.ensure_future(f(*args, **kwargs))
+                future.add_done_callback(partial(done, k))
+            # Cancellation of a single caller shouldn't cancel the call shared with others
+            return await asyncio.shield(future)
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
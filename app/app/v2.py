@@ -1,19 +1,67 @@
-from typing import Iterable
+from itertools import groupby
+from operator import itemgetter
+from typing import Dict, Iterable, List, Tuple
 
 from aiochclient import ChClient
-from aiohttp import ClientSession, ClientConnectorError
-from aiohttp.web import Application, Response, json_response, RouteTableDef, Request, HTTPInternalServerError
+from aiohttp.web import Response, RouteTableDef, Request, HTTPInternalServerError
 
-from .clichouse_host import CLICKHOUSE_HOST
-from .util import oids_from_request, ra_dec_radius_from_request, try_for_a_while
+from .util import async_lru_cache, coerce_floats, json_response, \
+    oids_from_request, ra_dec_radius_from_request
 
 MAX_RADIUS = 60
+# Cache holds at most META_CACHE_SIZE * META_CACHE_MAX_OIDS meta records
+META_CACHE_SIZE = 1024
+META_CACHE_MAX_OIDS = 16
+CLICKHOUSE_WAIT_FOR = 1
 
 
 FILTERS = {1: 'zg', 2: 'zr', 3: 'zi'}
 
 
-LC_FIELDS = {'mjd', 'mag', 'magerr', 'clrcoeff', 'catflags'}
+LC_FIELDS = ('mjd', 'mag', 'magerr', 'clrcoeff', 'catflags')
+LC_FLOAT_FIELDS = ('mjd', 'mag', 'magerr', 'clrcoeff')
+
+
+HELP = f'''
+    <h1>Available resources</h1>
+    <h2><font face='monospace'>/api/v2/oid/full/json</font></h2>
+        <p>Get json with the whole objects data by their identifiers</p>
+        <p>Query parameters:</p>
+        <ul>
+            <li>
+                <font face='monospace'>oid</font>
+                &mdash;
+                object identifier (OID).
+                Mandatory, multiple values accepted
+            </li>
+        </ul>
+        <p>Example: <font face='monospace'><a href="/api/v2/oid/full/json?oid=830202400008402">/api/v2/oid/full/json?oid=830202400008402</a></font></p>
+    <h2><font face='monospace'>/api/v2/circle/full/json</font></h2>
+        <p>Find objects in circle and return json with the whole data</p>
+        <p>Query parameters:</p>
+        <ul>
+            <li>
+                <font face='monospace'>ra</font>
+                &mdash;
+                right ascension of the circle center, degrees.
+                Mandatory
+            </li>
+            <li>
+                <font face='monospace'>dec</font>
+                &mdash;
+                declination of the circle center, degrees.
+                Mandatory
+            </li>
+            <li>
+                <font face='monospace'>radius_arcsec</font>
+                &mdash;
+                circle radius, acrseconds. Should be positive and less than {MAX_RADIUS}.
+                Mandatory
+            </li>
+        </ul>
+        <p>Example: <font face='monospace'><a href="/api/v2/circle/full/json?ra=10&dec=30&radius_arcsec=10">/api/v2/circle/full/json?ra=10&dec=30&radius_arcsec=10</a></font>
+'''
+_HELP_BYTES = HELP.encode('utf-8')
 
 
 routes = RouteTableDef()
@@ -22,59 +70,36 @@ routes = RouteTableDef()
 @routes.get('/api/v2/help')
 async def api_help(request) -> Response:
     return Response(
-        text=f'''
-            <h1>Available resources</h1>
-            <h2><font face='monospace'>/api/v2/oid/full/json</font></h2>
-                <p>Get json with the whole objects data by their identifiers</p>
-                <p>Query parameters:</p>
-                <ul>
-                    <li>
-                        <font face='monospace'>oid</font>
-                        &mdash;
-                        object identifier (OID).
-                        Mandatory, multiple values accepted
-                    </li>
-                </ul>
-                <p>Example: <font face='monospace'><a href="/api/v2/oid/full/json?oid=830202400008402">/api/v2/oid/full/json?oid=830202400008402</a></font></p>
-            <h2><font face='monospace'>/api/v2/circle/full/json</font></h2>
-                <p>Find objects in circle and return json with the whole data</p>
-                <p>Query parameters:</p>
-                <ul>
-                    <li>
-                        <font face='monospace'>ra</font>
-                        &mdash;
-                        right ascension of the circle center, degrees.
-                        Mandatory
-                    </li>
-                    <li>
-                        <font face='monospace'>dec</font>
-                        &mdash;
-                        declination of the circle center, degrees.
-                        Mandatory
-                    </li>
-                    <li>
-                        <font face='monospace'>radius_arcsec</font>
-                        &mdash;
-                        circle radius, acrseconds. Should be positive and less than {MAX_RADIUS}.
-                        Mandatory
-                    </li>
-                </ul>
-                <p>Example: <font face='monospace'><a href="/api/v2/circle/full/json?ra=10&dec=30&radius_arcsec=10">/api/v2/circle/full/json?ra=10&dec=30&radius_arcsec=10</a></font>
-        ''',
+        body=_HELP_BYTES,
         content_type='text/html',
+        charset='utf-8',
     )
 
 
-async def get_meta_for_oids(client: ChClient, oids: Iterable[int]) -> [dict]:
+async def fetch_meta_for_oids(client: ChClient, oids: Iterable[int]) -> [dict]:
     oids_array = '(' + ', '.join(map(str, oids)) + ')'
     records = await client.fetch(f"""
-        SELECT *
+        SELECT oid, h3index10, nobs, ngoodobs, durgood, filter, fieldid, rcid, ra, dec
         FROM dr2_meta
         WHERE oid IN {oids_array}
     """)
     return [dict(r) for r in records]
 
 
+# Meta table is never updated, so its records could be cached forever
+@async_lru_cache(maxsize=META_CACHE_SIZE, key=lambda client, oids: oids)
+async def _get_cached_meta_for_oids(client: ChClient, oids: Tuple[int, ...]) -> [dict]:
+    return await fetch_meta_for_oids(client, oids)
+
+
+async def get_meta_for_oids(client: ChClient, oids: Iterable[int]) -> [dict]:
+    """Cached fetch_meta_for_oids, large oid sets are not cached"""
+    oids = tuple(sorted(oids))
+    if len(oids) > META_CACHE_MAX_OIDS:
+        return await fetch_meta_for_oids(client, oids)
+    return await _get_cached_meta_for_oids(client, oids)
+
+
 def prepare_meta(meta: dict) -> dict:
     return dict(
         nobs=meta['nobs'],
@@ -88,44 +113,62 @@ def prepare_meta(meta: dict) -> dict:
     )
 
 
-async def get_lc_for_oid_h3index10(client: ChClient, oid: int, h3index10: int) -> [dict]:
+async def get_lcs_for_oids_h3index10(client: ChClient,
+                                     oids_h3index10: Iterable[Tuple[int, int]]) -> Dict[int, List[dict]]:
+    pairs = ','.join(f'({h3index10:d},{oid:d})' for oid, h3index10 in oids_h3index10)
+    if not pairs:
+        return {}
     records = await client.fetch(f"""
-        SELECT *
+        SELECT oid, {', '.join(LC_FIELDS)}
         FROM dr2
-        WHERE h3index10 = {h3index10:d} AND oid = {oid:d} AND catflags = 0
-        ORDER BY mjd
-    """)
-    return [dict(r) for r in records]
+        PREWHERE (h3index10, oid) IN ({pairs})
+        WHERE catflags = 0
+        ORDER BY oid, mjd
+    """, json=True)
+    lcs = {}
+    for oid, group in groupby(records, key=itemgetter('oid')):
+        lc = lcs[oid] = list(group)
+        for obs in lc:
+            del obs['oid']
+            coerce_floats(obs, LC_FLOAT_FIELDS)
+    return lcs
 
 
 @routes.get('/api/v2/oid/full/json')
 async def oid_full_json(request: Request) -> Response:
     oids = oids_from_request(request)
     metas = await get_meta_for_oids(request.app['ch_client'], oids)
+    lcs = await get_lcs_for_oids_h3index10(
+        request.app['ch_client'],
+        ((meta['oid'], meta['h3index10']) for meta in metas),
+    )
     data = {}
     for meta in metas:
         oid = meta['oid']
-        h3index10 = meta['h3index10']
-        lc = await get_lc_for_oid_h3index10(request.app['ch_client'], oid, h3index10)
         data[oid] = dict(
             meta=prepare_meta(meta),
-            lc=[{k: v for k, v in obs.items() if k in LC_FIELDS} for obs in lc],
+            lc=lcs.get(oid, []),
         )
     return json_response(data)
 
 
 async def get_lcs_in_circle(client: ChClient, ra: float, dec: float, radius_arcsec: float) -> [dict]:
     radius_deg = radius_arcsec / 3600.0
-    records = await client.fetch(f"""
-        SELECT *
+    records = await client.fetch(
+        f"""
+        SELECT oid, {', '.join(LC_FIELDS)}
         FROM dr2
-        WHERE h3index10 IN
+        PREWHERE h3index10 IN
         (
-            SELECT arrayJoin(h3kRing(geoToH3({ra:f}, {dec:f}, 10), toUInt8({radius_deg:f} / h3EdgeAngle(10)) + 1))
-        ) AND greatCircleAngle({ra:f}, {dec:f}, ra, dec) < {radius_deg:f}
+            SELECT arrayJoin(h3kRing(geoToH3({{ra}}, {{dec}}, 10), toUInt8({{radius_deg}} / h3EdgeAngle(10)) + 1))
+        )
+        WHERE greatCircleAngle({{ra}}, {{dec}}, ra, dec) < {{radius_deg}}
         ORDER BY (oid, mjd)
-    """)
-    return [dict(r) for r in records]
+        """,
+        params=dict(ra=ra, dec=dec, radius_deg=radius_deg),
+        json=True,
+    )
+    return records
 
 
 @routes.get('/api/v2/circle/full/json')
@@ -133,33 +176,16 @@ async def circle_full_json(request: Request) -> Response:
     ra, dec, radius = ra_dec_radius_from_request(request, MAX_RADIUS)
     lcs = await get_lcs_in_circle(request.app['ch_client'], ra, dec, radius)
     oids = set(obs['oid'] for obs in lcs)
-    metas = await get_meta_for_oids(request.app['ch_client'], oids)
+    # Circle oid sets are unlikely to repeat, so we don't pollute the cache with them
+    metas = await fetch_meta_for_oids(request.app['ch_client'], oids)
     metas = {meta['oid']: meta for meta in metas}
     if oids != set(metas):
         raise HTTPInternalServerError(reason='dr2 and dr2_meta return different oids')
     data = {}
-    for obs in lcs:
-        obj = data.setdefault(obs['oid'], dict(meta=prepare_meta(metas[obs['oid']])))
-        lc = obj.setdefault('lc', [])
-        lc.append({k: v for k, v in obs.items() if k in LC_FIELDS})
+    for oid, group in groupby(lcs, key=itemgetter('oid')):
+        lc = list(group)
+        for obs in lc:
+            del obs['oid']
+            coerce_floats(obs, LC_FLOAT_FIELDS)
+        data[oid] = dict(meta=prepare_meta(metas[oid]), lc=lc)
     return json_response(data)
-
-
-async def app_on_startup(app: Application):
-    app['ch_http_session'] = ClientSession()
-
-    async def ch_client():
-        client = ChClient(app['ch_http_session'], url=f'http://{CLICKHOUSE_HOST}:8123', database='ztf', user='api')
-        await client.fetch('SELECT 1')
-        return client
-
-    app['ch_client'] = await try_for_a_while(
-        ch_client,
-        wait_for=1,
-        interval=1,
-        exception=ClientConnectorError,
-    )
-
-
-async def app_on_cleanup(app: Application):
-    await app['ch_http_session'].close()
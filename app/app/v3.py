@@ -1,13 +1,15 @@
-from typing import Iterable, Optional
+import asyncio
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
 
 from aiochclient import ChClient
-from aiohttp import ClientSession, ClientConnectorError
-from aiohttp.web import Application, Response, json_response, RouteTableDef, Request, HTTPInternalServerError, \
-    HTTPNotFound
+from aiohttp.web import Response, RouteTableDef, Request, HTTPNotFound, StreamResponse
 
 from .available_drs import get_avail_drs
-from .clichouse_host import CLICKHOUSE_HOST
-from .util import oids_from_request, ra_dec_radius_from_request, try_for_a_while
+from .util import async_lru_cache, coerce_floats, json_dumps, json_response, \
+    oids_from_request, ra_dec_radius_from_request
 
 MAX_RADIUS = 60
 
@@ -15,7 +17,13 @@ MAX_RADIUS = 60
 FILTERS = {1: 'zg', 2: 'zr', 3: 'zi'}
 
 
-LC_FIELDS = {'mjd', 'mag', 'magerr', 'clrcoeff'}
+LC_FIELDS = ('mjd', 'mag', 'magerr', 'clrcoeff')
+
+
+META_COLUMNS = ('oid', 'h3index10', 'nobs', 'ngoodobs', 'durgood', 'filter', 'fieldid', 'rcid', 'ra', 'dec')
+META_SHORT_COLUMNS = ('oid', 'ngoodobs', 'durgood')
+# JSON output of ClickHouse loses float type of whole values
+META_FLOAT_COLUMNS = ('durgood', 'ra', 'dec')
 
 
 SUPPORTED_DRS = ('dr2', 'dr3', 'dr4', 'dr8', 'dr13', 'dr17')
@@ -23,6 +31,11 @@ _ALL_AVAILABLE_DRS = get_avail_drs()
 AVAILABLE_DRS = tuple(dr for dr in SUPPORTED_DRS if dr in _ALL_AVAILABLE_DRS) + ('latest',)
 SHORT_META_DRS = ('dr2', 'dr3')
 LATEST_DR = 'dr17'
+# Cache holds at most META_CACHE_SIZE * META_CACHE_MAX_OIDS meta records
+META_CACHE_SIZE = 1024
+META_CACHE_MAX_OIDS = 16
+CIRCLE_CHUNK_SIZE = 256
+CLICKHOUSE_WAIT_FOR = 900
 AVAILABLE_DRS_HTML = ', '.join(f"<font face='monospace'>{dr}</font>" for dr in AVAILABLE_DRS)
 
 
@@ -126,6 +139,7 @@ HELP = f'''
         </ul>
         <p>Example: <font face='monospace'><a href="/api/v3/data/latest/circle/full/json?ra=10&dec=30&radius_arcsec=10">/api/v3/data/latest/circle/full/json?ra=10&dec=30&radius_arcsec=10</a></font>
 '''
+_HELP_BYTES = HELP.encode('utf-8')
 
 
 routes = RouteTableDef()
@@ -134,8 +148,9 @@ routes = RouteTableDef()
 @routes.get('/api/v3/help')
 async def api_help(request) -> Response:
     return Response(
-        text=HELP,
+        body=_HELP_BYTES,
         content_type='text/html',
+        charset='utf-8',
     )
 
 
@@ -144,6 +159,8 @@ async def dr_list_json(request) -> Response:
     return json_response(AVAILABLE_DRS)
 
 
+# Exceptions are not cached, so unknown DRs don't grow the caches
+@lru_cache(maxsize=None)
 def _table_name_from_dr(dr: str) -> str:
     if dr not in AVAILABLE_DRS:
         msg = f"ZTF data release identify {dr} isn't supported"
@@ -153,15 +170,18 @@ def _table_name_from_dr(dr: str) -> str:
     return dr
 
 
+@lru_cache(maxsize=None)
 def observation_table(dr: str) -> str:
     return _table_name_from_dr(dr)
 
 
+@lru_cache(maxsize=None)
 def meta_table(dr: str) -> str:
     dr = _table_name_from_dr(dr)
     return f'{dr}_meta'
 
 
+@lru_cache(maxsize=None)
 def meta_short_table(dr: str) -> Optional[str]:
     dr = _table_name_from_dr(dr)
     if dr not in SHORT_META_DRS:
@@ -180,10 +200,10 @@ async def get_coord_for_oids(client: ChClient, table: str, oids: Iterable[int])
     return {r['oid']: {k: v for k, v in r.items() if k != 'oid'} for r in records}
 
 
-async def get_meta_for_oids(client: ChClient, table: str, oids: Iterable[int]) -> dict:
+async def fetch_meta_for_oids(client: ChClient, table: str, oids: Iterable[int], columns=META_COLUMNS) -> dict:
     oids_array = f'({",".join(map(str, oids))})'
     records = await client.fetch(f"""
-        SELECT *
+        SELECT {', '.join(columns)}
         FROM {table}
         WHERE oid IN {oids_array} AND ngoodobs > 0
     """)
@@ -191,6 +211,31 @@ async def get_meta_for_oids(client: ChClient, table: str, oids: Iterable[int]) -
     return {r['oid']: r for r in records}
 
 
+# Meta tables are never updated, so their records could be cached forever
+@async_lru_cache(maxsize=META_CACHE_SIZE, key=lambda client, table, oids, columns: (table, columns, oids))
+async def _get_cached_meta_for_oids(client: ChClient, table: str, oids: Tuple[int, ...], columns) -> dict:
+    return await fetch_meta_for_oids(client, table, oids, columns)
+
+
+async def get_meta_for_oids(client: ChClient, table: str, oids: Iterable[int], columns=META_COLUMNS) -> dict:
+    """Cached fetch_meta_for_oids, large oid sets are not cached"""
+    oids = tuple(sorted(oids))
+    if len(oids) > META_CACHE_MAX_OIDS:
+        return await fetch_meta_for_oids(client, table, oids, columns)
+    return await _get_cached_meta_for_oids(client, table, oids, columns)
+
+
+async def get_long_short_meta_for_oids(client: ChClient, dr: str, oids: Iterable[int]) -> Tuple[dict, dict]:
+    oids = list(oids)
+    short_table = meta_short_table(dr)
+    if short_table is None:
+        return await get_meta_for_oids(client, meta_table(dr), oids), {}
+    return await asyncio.gather(
+        get_meta_for_oids(client, meta_table(dr), oids),
+        get_meta_for_oids(client, short_table, oids, columns=META_SHORT_COLUMNS),
+    )
+
+
 def prepare_meta(long: dict, short: Optional[dict]) -> dict:
     record = dict(
         nobs=long['nobs'],
@@ -210,15 +255,27 @@ def prepare_meta(long: dict, short: Optional[dict]) -> dict:
     return record
 
 
-async def get_lc_for_oid_h3index10(client: ChClient, dr: str, oid: int, h3index10: int) -> [dict]:
+async def get_lcs_for_oids_h3index10(client: ChClient, dr: str,
+                                     oids_h3index10: Iterable[Tuple[int, int]]) -> Dict[int, List[dict]]:
     table = observation_table(dr)
+    pairs = ','.join(f'({h3index10:d},{oid:d})' for oid, h3index10 in oids_h3index10)
+    if not pairs:
+        return {}
     records = await client.fetch(f"""
-        SELECT *
+        SELECT oid, {', '.join(LC_FIELDS)}
         FROM {table}
-        WHERE h3index10 = {h3index10:d} AND oid = {oid:d} AND catflags = 0 AND magerr > 0
-        ORDER BY mjd
-    """)
-    return [dict(r) for r in records]
+        PREWHERE (h3index10, oid) IN ({pairs})
+        WHERE catflags = 0 AND magerr > 0
+        ORDER BY oid, mjd
+    """, json=True)
+    lcs = {}
+    for oid, group in groupby(records, key=itemgetter('oid')):
+        lc = lcs[oid] = list(group)
+        for obs in lc:
+            del obs['oid']
+            # all light-curve fields are floats
+            coerce_floats(obs, LC_FIELDS)
+    return lcs
 
 
 @routes.get('/api/v3/data/{dr}/oid/coord/json')
@@ -245,82 +302,120 @@ async def data_dr_oid_meta_json(request: Request) -> Response:
 async def data_dr_oid_full_json(request: Request) -> Response:
     dr = request.match_info['dr']
     oids = oids_from_request(request)
-    metas = await get_meta_for_oids(request.app['ch_client'], meta_table(dr), oids)
+    metas, metas_short = await get_long_short_meta_for_oids(request.app['ch_client'], dr, oids)
 
-    if metas_short := meta_short_table(dr):
-        metas_short = await get_meta_for_oids(request.app['ch_client'], metas_short, oids)
-    else:
-        metas_short = {}
+    lcs = await get_lcs_for_oids_h3index10(
+        request.app['ch_client'],
+        dr,
+        ((oid, meta['h3index10']) for oid, meta in metas.items()),
+    )
 
     data = {}
     for oid, meta in metas.items():
-        lc = await get_lc_for_oid_h3index10(request.app['ch_client'], dr, oid, meta['h3index10'])
         data[oid] = dict(
             meta=prepare_meta(meta, metas_short.get(oid, None)),
-            lc=[{k: v for k, v in obs.items() if k in LC_FIELDS} for obs in lc],
+            lc=lcs.get(oid, []),
         )
     return json_response(data)
 
 
-async def get_lcs_in_circle(client: ChClient, dr, ra: float, dec: float, radius_arcsec: float) -> [dict]:
+def iterate_circle(client: ChClient, dr, ra: float, dec: float, radius_arcsec: float) -> AsyncIterator[dict]:
+    """Objects in circle with their light curves as "lc" arrays of LC_FIELDS tuples sorted by mjd, joined with
+    long and short meta, which columns are prefixed by meta_ and short_"""
     table = observation_table(dr)
+    short_table = meta_short_table(dr)
     radius_deg = radius_arcsec / 3600.0
-    records = await client.fetch(f"""
-        SELECT *
+    # Table names are substituted by f-string, while values are escaped by aiochclient
+    h3_ring = """
+        SELECT arrayJoin(h3kRing(geoToH3({ra}, {dec}, 10), toUInt8({radius_deg} / h3EdgeAngle(10)) + 1))
+    """
+    circle = f"""
         FROM {table}
-        WHERE h3index10 IN
+        PREWHERE h3index10 IN ({h3_ring})
+        WHERE greatCircleAngle({{ra}}, {{dec}}, ra, dec) < {{radius_deg}} AND catflags = 0 AND magerr > 0
+    """
+    meta_columns = ', '.join(f'{column} AS meta_{column}' for column in META_COLUMNS if column != 'oid')
+    # Meta side is limited by the same h3 ring, INNER JOIN on oid does the exact matching.
+    # mjd is the first of LC_FIELDS
+    query = f"""
+        SELECT *
+        FROM
         (
-            SELECT arrayJoin(h3kRing(geoToH3({ra:f}, {dec:f}, 10), toUInt8({radius_deg:f} / h3EdgeAngle(10)) + 1))
-        ) AND greatCircleAngle({ra:f}, {dec:f}, ra, dec) < {radius_deg:f} AND catflags = 0 AND magerr > 0
-        ORDER BY h3index10, oid, mjd
-    """)
-    return [dict(r) for r in records]
+            SELECT oid, arraySort(x -> x.1, groupArray(({', '.join(LC_FIELDS)}))) AS lc
+            {circle}
+            GROUP BY oid
+        ) AS obs
+        INNER JOIN
+        (
+            SELECT oid, {meta_columns}
+            FROM {meta_table(dr)}
+            WHERE h3index10 IN ({h3_ring}) AND ngoodobs > 0
+        ) AS meta USING (oid)
+    """
+    if short_table is not None:
+        short_columns = ', '.join(f'{column} AS short_{column}' for column in META_SHORT_COLUMNS if column != 'oid')
+        query += f"""
+        ANY LEFT JOIN
+        (
+            SELECT oid, {short_columns}
+            FROM {short_table}
+            WHERE oid IN (SELECT oid FROM {meta_table(dr)} WHERE h3index10 IN ({h3_ring})) AND ngoodobs > 0
+        ) AS short USING (oid)
+        """
+    # lc tuples must be JSON arrays even if the server makes them named tuples
+    query += """
+        ORDER BY oid
+        SETTINGS join_use_nulls = 1, output_format_json_named_tuples_as_objects = 0
+    """
+    return client.iterate(
+        query,
+        params=dict(ra=ra, dec=dec, radius_deg=radius_deg),
+        json=True,
+    )
+
+
+def prepare_meta_from_circle_row(row: dict) -> dict:
+    long = {column: row[f'meta_{column}'] for column in META_COLUMNS if column != 'oid'}
+    coerce_floats(long, META_FLOAT_COLUMNS)
+    if row.get('short_ngoodobs') is None:
+        short = None
+    else:
+        short = {column: row[f'short_{column}'] for column in META_SHORT_COLUMNS if column != 'oid'}
+        coerce_floats(short, ('durgood',))
+    return prepare_meta(long, short)
 
 
 @routes.get('/api/v3/data/{dr}/circle/full/json')
-async def data_dr_circle_full_json(request: Request) -> Response:
+async def data_dr_circle_full_json(request: Request) -> StreamResponse:
     dr = request.match_info['dr']
     ra, dec, radius = ra_dec_radius_from_request(request, MAX_RADIUS)
-    lcs = await get_lcs_in_circle(request.app['ch_client'], dr, ra, dec, radius)
-
-    if not lcs:
-        return json_response({})
-
-    oids = set(obs['oid'] for obs in lcs)
-
-    metas = await get_meta_for_oids(request.app['ch_client'], meta_table(dr), oids)
-    if oids != set(metas):
-        raise HTTPInternalServerError(reason='observation and meta requests returned different oids')
-
-    if metas_short := meta_short_table(dr):
-        metas_short = await get_meta_for_oids(request.app['ch_client'], metas_short, oids)
-    else:
-        metas_short = {}
 
+    # Every row is a single object, so we send data in chunks of objects
+    response = None
     data = {}
-    for obs in lcs:
-        oid = obs['oid']
-        obj = data.setdefault(oid, dict(meta=prepare_meta(metas[oid], metas_short.get(oid, None))))
-        lc = obj.setdefault('lc', [])
-        lc.append({k: v for k, v in obs.items() if k in LC_FIELDS})
-    return json_response(data)
-
-
-async def app_on_startup(app: Application):
-    app['ch_http_session'] = ClientSession()
-
-    async def ch_client():
-        client = ChClient(app['ch_http_session'], url=f'http://{CLICKHOUSE_HOST}:8123', database='ztf', user='api')
-        await client.fetch('SELECT 1')
-        return client
-
-    app['ch_client'] = await try_for_a_while(
-        ch_client,
-        wait_for=900,
-        interval=1,
-        exception=ClientConnectorError,
-    )
+    async for row in iterate_circle(request.app['ch_client'], dr, ra, dec, radius):
+        if len(data) >= CIRCLE_CHUNK_SIZE:
+            # JSON object without enclosing braces
+            chunk = json_dumps(data)[1:-1]
+            if response is None:
+                response = StreamResponse()
+                response.content_type = 'application/json'
+                await response.prepare(request)
+                await response.write(b'{' + chunk)
+            else:
+                await response.write(b',' + chunk)
+            data = {}
+        data[row['oid']] = dict(
+            meta=prepare_meta_from_circle_row(row),
+            lc=[coerce_floats(dict(zip(LC_FIELDS, obs)), LC_FIELDS) for obs in row['lc']],
+        )
 
+    # Everything fits into a single chunk, no need to stream
+    if response is None:
+        return json_response(data)
 
-async def app_on_cleanup(app: Application):
-    await app['ch_http_session'].close()
+    if data:
+        await response.write(b',' + json_dumps(data)[1:-1])
+    await response.write(b'}')
+    await response.write_eof()
+    return response